@@ -1,91 +1,114 @@
+import asyncio
 import datetime
 import os
-import requests
-import http.client
-import urllib
+import socket
+import httpx
+import orjson
+from cachetools import LRUCache, TTLCache, cached
+from cachetools.keys import hashkey
 
-import julian
-from collections import defaultdict
-from PyAstronomy import pyasl
+import numpy as np
 
-from dotenv import load_dotenv
-load_dotenv()
+# Lambda injects the environment itself, so only look for a .env file when running locally
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is None:
+    from dotenv import load_dotenv
+    load_dotenv()
 
-home_lat= os.environ.get('home_lat')
-home_lon= os.environ.get('home_lon')
+FORECAST_URL = 'https://api.tomorrow.io/v4/weather/forecast?location={lat},{lon}&fields=visibility,cloudCover&timesteps=1h&apikey={api_key}'
 
-pushover_token = os.environ.get('pushover_token')
-pushover_user = os.environ.get('pushover_user')
+MONTHS = ('January', 'February', 'March', 'April', 'May', 'June',
+          'July', 'August', 'September', 'October', 'November', 'December')
 
-def json_extract(obj, key):
-    """Nested json extract function
+# Shared client and event loop, kept at module scope so warm Lambda invocations reuse the same TCP/TLS sessions.
+# Idle connections are kept for 5 minutes with TCP keepalive on, so a warm invocation skips DNS and the handshake entirely
+_http = httpx.AsyncClient(timeout=10, transport=httpx.AsyncHTTPTransport(
+    http2=True,
+    retries=1,
+    limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300),
+    socket_options=[(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)],
+))
+_loop = asyncio.new_event_loop()
 
-    Args:
-        obj (dict): Dictionary you're searching through
-        key (str): Key you're looking for
+# Moon position/phase per Julian Day Number, see _moon_core
+_moon_cache = LRUCache(maxsize=32)
 
-    Returns:
-        list: Returns a list of every dictionary value at key
-    """    
-    arr = []
-
-
-    def extract(obj, arr, key):
-        # If object is a dictionary, for kv pair check if v is a dictionary as well
-        if isinstance(obj, dict):
-            for k, v in obj.items():
-                # If so, recursively run the function. 
-                if isinstance(v, (dict, list)):
-                    extract(v, arr, key)
-                # If not, check if k is a match and append to array if so
-                elif k == key:
-                    arr.append(v)
-        # If object is a list, run a similar process but with list items
-        elif isinstance(obj, list):
-            for item in obj:
-                extract(item, arr, key)
-        return arr
-
-    values = extract(obj, arr, key)
-    return values
-
-def send_notification(message):
+# Hourly sky forecast requests, keyed on (lat, lon). The forecast barely changes within the half hour
+_sky_cache = TTLCache(maxsize=8, ttl=1800)
+
+async def send_notification(message):
     """Uses Pushover API to send notifications directly to one's phone. https://pushover.net/
 
     Args:
         message(str, required): Message you're looking to send.
     """  
 
-    conn = http.client.HTTPSConnection("api.pushover.net:443")
-    conn.request("POST", "/1/messages.json",
-    urllib.parse.urlencode({
+    pushover_token = os.environ.get('pushover_token')
+    pushover_user = os.environ.get('pushover_user')
+
+    # Form-encoded body, sent over the shared client
+    await _http.post("https://api.pushover.net/1/messages.json", data={
         "token": f"{pushover_token}",
         "user": f"{pushover_user}",
         "message": message,
-    }), { "Content-type": "application/x-www-form-urlencoded" })
-    conn.getresponse()
+    })
 
-def get_5_day_moon_forecast():
-    """Returns a dataframe containing the Illum, Dist, Lon, and Lat of the moon for the past 5 days.
+@cached(_moon_cache)
+def _moon_core(jd_int):
+    """Computes the moon position and phase for the 6 days starting at jd_int. Cached, as these only change day to day.
+
+    Args:
+        jd_int (int): Julian Day Number of the first day.
 
     Returns:
-        df: Returns dataframe
-    """   
+        tuple: Returns the (pos, phase) arrays from pyasl
+    """
+
+    # Imported here rather than at module scope. On a cold start the slow import then runs in the worker thread,
+    # overlapping the sky forecast request instead of delaying it
+    from PyAstronomy import pyasl
 
     # Julian Date - Creates an array of dates for the next 5 days. Extra day added for padding
-    jd = pyasl.jdcnv(datetime.datetime.now())
-    jd_list = []
-    for i in range(0,6):
-        jd_list.append(jd+i)
+    jds = jd_int + np.arange(6)
 
     # Moon Position
-    pos = pyasl.moonpos(jd_list)
-    
+    pos = pyasl.moonpos(jds)
+
     # Moon Phase
-    phase = pyasl.moonphase(jd_list)
+    phase = pyasl.moonphase(jds)
+
+    return pos, phase
+
+def _today_jd_int():
+    """Returns the Julian Day Number of today (noon UTC). Bucketing to the day lets consecutive runs on the same day hit the cache.
+
+    Returns:
+        int: Returns the Julian Day Number
+    """
+
+    # Computed from the Unix epoch (JD 2440587.5) so pyasl is only needed on a cache miss
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return int(now.timestamp() / 86400.0 + 2440587.5 + 0.5)
+
+def get_5_day_moon_forecast(jd_int=None):
+    """Returns a dataframe containing the Illum, Dist, Lon, and Lat of the moon for the past 5 days.
+
+    Args:
+        jd_int (int): Julian Day Number of the first day. Defaults to today.
+
+    Returns:
+        df: Returns dataframe
+    """   
+
+    if jd_int is None:
+        jd_int = _today_jd_int()
+    pos, phase = _moon_core(jd_int)
+
+    # Days since the Unix epoch (JD 2440587.5), truncated to whole days and formatted as 'YYYY-MM-DD' in one go
+    jds = jd_int + np.arange(6)
+    dates = (jds - 2440587.5).astype(np.int64).astype('datetime64[D]').astype(str).tolist()
 
     moon_dict = {
-        'date':[datetime.datetime.strftime(julian.from_jd(jd), '%Y-%m-%d') for jd in jd_list],
+        'date':dates,
         'illum':phase*100,
         'dist':pos[2],
         'geo_lon':pos[3],
@@ -94,13 +117,59 @@ def get_5_day_moon_forecast():
 
     return moon_dict
 
-def get_5_day_sky_forecast(home_lat, home_lon, start_hour=6, end_hour=13):
+async def _request_hourly_sky(lat, lon):
+    """Requests the hourly sky forecast from tomorrow.io. https://www.tomorrow.io/
+
+    Args:
+        lat (float): Latitude of the location you wish to view from.
+        lon (float): Longitude of the location you wish to view from.
+
+    Returns:
+        tuple: Returns the (time, vis, cover) lists of the hourly forecast
+    """
+
+    # API Request. Only the hourly visibility and cloud cover are requested, and httpx already asks for a gzip'd body,
+    # keeping the response small
+    api_key = os.environ.get('weather_api_key')
+    response = await _http.get(FORECAST_URL.format(lat=lat, lon=lon, api_key=api_key))
+    data = orjson.loads(response.content)
+
+    # Pull 'time', 'visibility', and 'cloudCover' out of each hourly entry. The response shape is fixed, so no searching is needed
+    hourly = data['timelines']['hourly']
+    time = [h['time'] for h in hourly]
+    vis = [h['values']['visibility'] for h in hourly]
+    cover = [h['values']['cloudCover'] for h in hourly]
+
+    return time, vis, cover
+
+def fetch_hourly_sky(lat, lon):
+    """Starts the hourly sky forecast request, or reuses the one made for the same location in the last 30 minutes.
+
+    Args:
+        lat (float): Latitude of the location you wish to view from.
+        lon (float): Longitude of the location you wish to view from.
+
+    Returns:
+        Task: Returns a task resolving to the (time, vis, cover) lists of the hourly forecast
+    """
+
+    # Tasks are cached rather than results, so a request already in flight is shared instead of being sent twice.
+    # Failed or cancelled requests are never reused
+    key = (lat, lon)
+    task = _sky_cache.get(key)
+    if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+        task = asyncio.create_task(_request_hourly_sky(lat, lon))
+        _sky_cache[key] = task
+
+    return task
+
+async def get_5_day_sky_forecast(lat, lon, dates=None, start_hour=6, end_hour=13):
     """Returns a dataframe containing the Visibility and Cloud Coverage of the nighttime sky for the past 5 days.
 
     Args:
         lat (float): Latitude of the location you wish to view from.
         lon (float): Longitude of the location you wish to view from.
-        tz (str): Timezone, ex: 'America/Los_Angeles'
+        dates (iterable): Only aggregate these 'YYYY-MM-DD' dates. Defaults to every date in the forecast.
         start_hour (int): The start of "Nighttime" for filtering out day hours when calculating averages.
         end_hour (int): The start of "Nighttime" for filtering out day hours when calculating averages.
 
@@ -108,60 +177,33 @@ def get_5_day_sky_forecast(home_lat, home_lon, start_hour=6, end_hour=13):
         df: Returns dataframe
     """   
 
-    # API Request
-    api_key = os.environ.get('weather_api_key')
-    response = requests.get(f'https://api.tomorrow.io/v4/weather/forecast?location={home_lat},{home_lon}&apikey={api_key}')
-
-    # Extract the values of every 'time', 'visibility', and 'cloudCover' key in the response dictionary
-    time = json_extract(response.json()['timelines']['hourly'], 'time')
-    vis = json_extract(response.json()['timelines']['hourly'], 'visibility')
-    cover = json_extract(response.json()['timelines']['hourly'], 'cloudCover')
-
-    # Create a defaultdict to store data for each day
-    sky_dict = defaultdict(lambda: {'date': None, 'vis_avg': 0, 'cover_avg': 0})
-
-    # Iterate through the timestamps and aggregate data
-
-    first_day = time[0].split('T')[0]
-    prev_day = None
-    target_day = None
-    vis_list = []
-    cover_list = []
-
-    sky_list = list(zip(time,vis,cover))
-
-    # Makes a list of every timestamp between start_hour and end_hour, this is considered "nighttime"
-    accepted_times = [f'{i:02d}:00:00Z' for i in range(start_hour, end_hour)]
-
-    # For every timestamp in the hourly forecast
-    for timestamp in sky_list:
-        
-        # Filter out day hours based on start_hour and end_hour
-        day, vis, cover = timestamp
-        if day.split('T')[1] in accepted_times:
-
-            # Grab the date from the timestamp
-            day_key = day.split('T')[0]
-
-            # Append vis/cover to appropriate lists, once next day is reached, insert the vis/cover averages into sky_dict
-            sky_dict[day_key]['date'] = day_key
-            if (day_key == target_day) or (day_key == first_day):
-                vis_list.append(vis)
-                cover_list.append(cover)
-                prev_day = day_key
-            else:
-                sky_dict[prev_day]['vis_avg'] = sum(vis_list)/len(vis_list)
-                sky_dict[prev_day]['cover_avg'] += sum(cover_list)/len(cover_list)
-                vis_list = []
-                cover_list = []
-                target_day = day_key
-        
-    # Convert the defaultdict to a list of dictionaries
-    sky_dict = list(sky_dict.values())
+    time, vis, cover = await fetch_hourly_sky(lat, lon)
+
+    # Split each timestamp ('YYYY-MM-DDTHH:MM:SSZ') into its date and hour
+    days = np.array([t[:10] for t in time])
+    hours = np.array([int(t[11:13]) for t in time])
+
+    # Only keep the hours between start_hour and end_hour, this is considered "nighttime"
+    mask = (hours >= start_hour) & (hours < end_hour)
+
+    # Skip every day that isn't asked for
+    if dates is not None:
+        mask &= np.isin(days, list(dates))
+
+    vis_a = np.asarray(vis, dtype=np.float64)[mask]
+    cov_a = np.asarray(cover, dtype=np.float64)[mask]
+
+    # Group the remaining hours by date and average vis/cover per day
+    uniq, inv = np.unique(days[mask], return_inverse=True)
+    counts = np.bincount(inv)
+    vis_avg = np.bincount(inv, weights=vis_a) / counts
+    cov_avg = np.bincount(inv, weights=cov_a) / counts
+
+    sky_dict = [{'date': d, 'vis_avg': va, 'cover_avg': ca} for d, va, ca in zip(uniq.tolist(), vis_avg.tolist(), cov_avg.tolist())]
 
     return sky_dict
     
-def find_stargazing_dates(illum_threshold, vis_threshold, cover_threshold, home_lat, home_lon):
+async def find_stargazing_dates(illum_threshold, vis_threshold, cover_threshold, home_lat, home_lon):
     """Returns a list of dates that meet the Illum, Vis and Cover thresholds over the past 5 days.
 
     Args:
@@ -176,41 +218,64 @@ def find_stargazing_dates(illum_threshold, vis_threshold, cover_threshold, home_
         df: Returns dataframe
     """   
 
-    moon = get_5_day_moon_forecast()
+    # Illumination is a percentage, so no day can ever meet a threshold above 100. Skip the API call entirely
+    if illum_threshold > 100:
+        return []
+
+    jd_int = _today_jd_int()
+    if hashkey(jd_int) in _moon_cache:
+        # Today's moon is already cached, so the qualifying days are known before anything touches the network
+        sky_task = None
+        moon = get_5_day_moon_forecast(jd_int)
+    else:
+        # First run of the day: start the sky forecast request, then compute the moon forecast in a thread so the two overlap.
+        # The trade-off is that on bright-moon days the request is usually sent (and counted against the API quota) before
+        # it can be cancelled below
+        sky_task = fetch_hourly_sky(home_lat, home_lon)
+        moon = await asyncio.to_thread(get_5_day_moon_forecast, jd_int)
 
     # Filtering the moon dataframe to find dates where new moons can be found
-    new_moons = [index for index, value in enumerate(moon['illum']) if value >= illum_threshold]
-    new_moon_dates = [value for index, value in enumerate(moon['date']) if index in new_moons]
+    mask = np.asarray(moon['illum']) >= illum_threshold
+    new_moon_dates = set(np.asarray(moon['date'])[mask].tolist())
 
     stargazing_dates = []
 
     # If new moons are found, check the sky forecast on that day. If the visibility and cloud coverage meet the appropriate day
     # Append to stargazing_dates
-    if len(new_moons) > 0:
-        sky = get_5_day_sky_forecast(home_lat, home_lon)
+    if len(new_moon_dates) > 0:
+        sky = await get_5_day_sky_forecast(home_lat, home_lon, new_moon_dates)
         for day in sky:
             if day['date'] in new_moon_dates:
                 if day['vis_avg'] > vis_threshold and day['cover_avg'] < cover_threshold:
                     stargazing_dates.append(day['date'])
+    elif sky_task is not None:
+        sky_task.cancel()
     
     return stargazing_dates
 
-def handler(events, lambda_context):
+async def main():
 
     vis_threshold = 20
     cover_threshold = 5
     illum_threshold = 2
 
-    forecast = find_stargazing_dates(illum_threshold, vis_threshold, cover_threshold, home_lat, home_lon)
+    home_lat = os.environ.get('home_lat')
+    home_lon = os.environ.get('home_lon')
+
+    forecast = await find_stargazing_dates(illum_threshold, vis_threshold, cover_threshold, home_lat, home_lon)
     
     if len(forecast) > 0:
-        message = f"""Upcoming Stargazing Dates!"""
-        for i in range(len(forecast)):
-            date = datetime.datetime.strptime(forecast[i], '%Y-%m-%d')
-            message += f"""\n\t- {date.strftime("%B")} {date.day}, {date.year}"""
-        send_notification(message)
+        parts = ["Upcoming Stargazing Dates!"]
+        for day in forecast:
+            date = datetime.date.fromisoformat(day)
+            parts.append(f"""\n\t- {MONTHS[date.month-1]} {date.day}, {date.year}""")
+        message = "".join(parts)
+        await send_notification(message)
     else:
         print('No upcoming stargazing dates!')
 
+def handler(events, lambda_context):
+    _loop.run_until_complete(main())
+
 if __name__ == "__main__":
     handler("","")
\ No newline at end of file